@@ -1,10 +1,52 @@
+import base64
 import boto3
 import csv
+import gzip
+import hashlib
+import json
 import os
+import random
+import threading
 import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 CSV_FILE = os.getenv("WORKSPACES_CSV", "workspaces.csv")
+REPORT_CSV = os.getenv("REPORT_CSV", "install_report.csv")
+REPORT_JSONL = os.getenv("REPORT_JSONL", "")  # Optional machine-readable event stream
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+# Cap in-flight SendCommand calls below the worker count so batches that
+# start together don't all hit the SSM throttling threshold at once
+MAX_INFLIGHT_SENDS = int(os.getenv("MAX_INFLIGHT_SENDS", str(max(1, MAX_WORKERS // 2))))
+# Poll often while short scripts finish, then back off for long installers
+POLL_MIN = 2
+POLL_MAX = 30
+COMMAND_TIMEOUT = int(os.getenv("COMMAND_TIMEOUT", "3600"))
+SSM_CACHE_FILE = os.path.expanduser(os.getenv("SSM_CACHE_FILE", "~/.cache/ws_ssm_map.json"))
+SSM_CACHE_TTL = int(os.getenv("SSM_CACHE_TTL", "900"))
+REFRESH_SSM_CACHE = os.getenv("REFRESH_SSM_CACHE", "").lower() in ("1", "true", "yes")
+# When set, scripts are uploaded here once and agents fetch them with AWS-RunRemoteScript
+SCRIPTS_BUCKET = os.getenv("SCRIPTS_BUCKET", "")
+SCRIPTS_PREFIX = "ps-installers"
+PROBE_INSTALLED = os.getenv("PROBE_INSTALLED", "true").lower() in ("1", "true", "yes")
+# The probe is a few registry/service lookups; don't let an unresponsive
+# workspace hold its batch for the full COMMAND_TIMEOUT before installing
+PROBE_TIMEOUT = int(os.getenv("PROBE_TIMEOUT", "90"))
+SSM_BATCH_SIZE = 50  # SendCommand accepts at most 50 InstanceIds per call
+WORKSPACES_BATCH_SIZE = 25  # DescribeWorkspaces accepts at most 25 WorkspaceIds per call
+MAX_RETRIES = 5
+MAX_BACKOFF = 30
+THROTTLING_ERRORS = ("ThrottlingException", "RequestLimitExceeded")
+OUTPUT_SNIPPET = 200  # Characters of command output kept for readability
+TERMINAL_STATUSES = ("Success", "Failed", "Cancelled", "TimedOut")
 
 # Name mapping of packages to PowerShell scripts (stored in S3 or inline)
 name_map = {
@@ -18,94 +60,532 @@ name_map = {
     "bigfix": "bigfix.ps1",
 }
 
-# AWS Clients
-ssm = boto3.client("ssm", region_name=AWS_REGION)
-workspaces = boto3.client("workspaces", region_name=AWS_REGION)
+# PowerShell checks copied from each script's own "already installed" exit.
+# Only scripts that do nothing else when the package is present are probed;
+# skipping them loses just their local "already installed" log line. Left out:
+# nessus (repairs the service and server link), bit9 and winlogbeat (reset
+# the time zone first) and splunk/bit9 (write an "already installed" event).
+PROBE_CHECKS = {
+    "zscaler": "[bool](Get-WmiObject -Class Win32_Product | Where-Object { $_.Name -match 'Zscaler' })",
+    "elastic": r"Test-Path 'C:\Program Files\Elastic\Agent\elastic-agent.exe'",
+    "crowdstrike": (
+        r"[bool](Get-ItemProperty HKLM:\Software\Microsoft\Windows\CurrentVersion\Uninstall\* 2>$null |"
+        " Where-Object { $_.DisplayName -match 'CrowdStrike' })"
+    ),
+    "bigfix": "[bool](Get-Service BESClient -ErrorAction SilentlyContinue)",
+}
+
+PROBE_SCRIPT = "@{\n%s\n} | ConvertTo-Json -Compress" % "\n".join(
+    f"    '{pkg}' = {check}" for pkg, check in PROBE_CHECKS.items()
+)
+
+PROBE_PARAMS = {
+    "DocumentName": "AWS-RunPowerShellScript",
+    "Parameters": {"commands": [PROBE_SCRIPT]},
+    "Comment": "install-probe",
+}
+
+# AWS Clients: one session and one client per service, shared by all workers
+# so credentials are resolved once. Adaptive retry mode adds client-side rate
+# limiting; the pool is sized so worker threads never queue for a connection.
+session = boto3.session.Session(region_name=AWS_REGION)
+client_config = Config(
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    max_pool_connections=max(32, MAX_WORKERS * 2),
+)
+ssm = session.client("ssm", config=client_config)
+workspaces = session.client("workspaces", config=client_config)
+s3 = session.client("s3", config=client_config)
+
+send_slots = threading.Semaphore(MAX_INFLIGHT_SENDS)
+
+REPORT_FIELDS = ["workspace_id", "username", "package", "status", "output"]
+
+
+def read_workspaces(path):
+    """Read workspace_id/username rows from the CSV, matching headers case-insensitively."""
+    # utf-8-sig drops the BOM that Excel writes at the start of CSV exports
+    with open(path, newline="", encoding="utf-8-sig") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        columns = {h.strip().lower(): i for i, h in enumerate(header)}
+        ws_idx = columns.get("workspace_id", columns.get("workspaceid"))
+        user_idx = columns.get("username", columns.get("user"))
+        if ws_idx is None or user_idx is None:
+            raise ValueError(f"{path} must have workspace_id and username columns, got {header}")
+
+        return [
+            {"workspace_id": r[ws_idx].strip(), "username": r[user_idx].strip() if len(r) > user_idx else ""}
+            for r in reader
+            if len(r) > ws_idx and r[ws_idx].strip()
+        ]
+
+
+def chunked(items, size):
+    """Yield successive lists of at most size items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def call_with_backoff(func, **kwargs):
+    """Call an AWS API, retrying with jittered exponential backoff when throttled."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLING_ERRORS or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, 2 ** attempt)))
+
+
+def describe_workspace_batch(workspace_ids):
+    """Return {WorkspaceId: ComputerName} for up to 25 workspaces."""
+    paginator = workspaces.get_paginator("describe_workspaces")
+    return {
+        ws["WorkspaceId"]: ws.get("ComputerName", "")
+        for page in paginator.paginate(WorkspaceIds=workspace_ids)
+        for ws in page["Workspaces"]
+    }
+
+
+def describe_workspaces(workspace_ids):
+    """Look up the computer name of every workspace in a few batched calls.
+
+    Returns ({WorkspaceId: ComputerName}, {WorkspaceId: error message}). A
+    chunk the API rejects (e.g. one malformed ID) is retried one ID at a time
+    so only the bad rows are reported as errors.
+    """
+    found, errors = {}, {}
+    for chunk in chunked(workspace_ids, WORKSPACES_BATCH_SIZE):
+        try:
+            found.update(call_with_backoff(describe_workspace_batch, workspace_ids=chunk))
+            continue
+        except ClientError as e:
+            if len(chunk) == 1:
+                errors[chunk[0]] = str(e)
+                continue
+        for workspace_id in chunk:
+            try:
+                found.update(call_with_backoff(describe_workspace_batch, workspace_ids=[workspace_id]))
+            except ClientError as e:
+                errors[workspace_id] = str(e)
+    return found, errors
 
 
-def get_instance_id_from_workspace(workspace_id):
-    """Get EC2 instance ID from Workspace ID."""
-    response = workspaces.describe_workspaces(WorkspaceIds=[workspace_id])
-    if not response["Workspaces"]:
-        raise Exception(f"No workspace found for {workspace_id}")
-    return response["Workspaces"][0]["WorkspaceId"], response["Workspaces"][0]["ComputerName"]
+def describe_managed_instances(instance_ids):
+    """Return which of up to 50 instance IDs are registered with SSM and online."""
+    paginator = ssm.get_paginator("describe_instance_information")
+    pages = paginator.paginate(
+        Filters=[{"Key": "InstanceIds", "Values": instance_ids}],
+        PaginationConfig={"PageSize": SSM_BATCH_SIZE},
+    )
+    # ConnectionLost/Inactive instances would leave commands Pending until timeout
+    return {
+        info["InstanceId"]
+        for page in pages
+        for info in page["InstanceInformationList"]
+        if info.get("PingStatus") == "Online"
+    }
 
 
-def send_ssm_command(instance_id, script_name):
-    """Send SSM RunCommand to instance for PowerShell script."""
-    with open(f"scripts/{script_name}", "r") as f:
-        ps_script = f.read()
+def load_ssm_cache():
+    """Load cached SSM registration lookups, or start empty."""
+    try:
+        with open(SSM_CACHE_FILE, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
 
-    response = ssm.send_command(
-        InstanceIds=[instance_id],
-        DocumentName="AWS-RunPowerShellScript",
-        Parameters={"commands": [ps_script]},
+
+def is_fresh(entry, now):
+    """Return True for a well-formed positive cache entry younger than the TTL."""
+    return (
+        isinstance(entry, dict)
+        and entry.get("present") is True
+        and isinstance(entry.get("ts"), (int, float))
+        and now - entry["ts"] <= SSM_CACHE_TTL
     )
+
+
+def save_ssm_cache(cache):
+    """Persist SSM registration lookups for later runs."""
+    try:
+        cache_dir = os.path.dirname(SSM_CACHE_FILE)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(SSM_CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"[WARN] Could not write SSM cache {SSM_CACHE_FILE}: {e}")
+
+
+def lookup_managed_instances(instance_ids):
+    """Check a chunk of instance IDs against SSM, one ID at a time if it is rejected.
+
+    Returns (set of online IDs, {instance_id: error message}).
+    """
+    try:
+        return call_with_backoff(describe_managed_instances, instance_ids=instance_ids), {}
+    except ClientError as e:
+        if len(instance_ids) == 1:
+            return set(), {instance_ids[0]: str(e)}
+
+    found, errors = set(), {}
+    for instance_id in instance_ids:
+        try:
+            found |= call_with_backoff(describe_managed_instances, instance_ids=[instance_id])
+        except ClientError as e:
+            errors[instance_id] = str(e)
+    return found, errors
+
+
+def resolve_ssm_managed_instances(instance_ids):
+    """Return the instance IDs that are online in SSM, plus {instance_id: error}
+    for IDs the lookup rejected."""
+    cache = load_ssm_cache()
+    entries = cache.get(AWS_REGION)
+    if not isinstance(entries, dict):
+        entries = cache[AWS_REGION] = {}
+    now = time.time()
+
+    # Only ask SSM about instances without a fresh positive entry; negative
+    # entries are always rechecked so newly registered workspaces show up.
+    # REFRESH_SSM_CACHE rechecks this run's IDs but keeps everyone else's.
+    stale = [i for i in instance_ids if REFRESH_SSM_CACHE or not is_fresh(entries.get(i), now)]
+    errors = {}
+    for chunk in chunked(stale, SSM_BATCH_SIZE):
+        found, chunk_errors = lookup_managed_instances(chunk)
+        errors.update(chunk_errors)
+        for instance_id in chunk:
+            if instance_id not in chunk_errors:
+                entries[instance_id] = {"present": instance_id in found, "ts": now}
+    if stale:
+        save_ssm_cache(cache)
+
+    managed = {i for i in instance_ids if is_fresh(entries.get(i), now)}
+    return managed, errors
+
+
+def compress_script(ps_script):
+    """Wrap a PowerShell script as a gzip+base64 payload that unpacks and runs itself."""
+    encoded = base64.b64encode(gzip.compress(ps_script.encode("utf-8"))).decode("ascii")
+    # A script block (rather than Invoke-Expression) keeps param() defaults
+    # and lets the script's exit codes reach SSM unchanged.
+    return (
+        f"$b=[Convert]::FromBase64String('{encoded}'); "
+        "$ms=New-Object IO.MemoryStream(,$b); "
+        "$gz=New-Object IO.Compression.GzipStream($ms,[IO.Compression.CompressionMode]::Decompress); "
+        "& ([scriptblock]::Create((New-Object IO.StreamReader($gz)).ReadToEnd()))"
+    )
+
+
+def upload_script(script_name, ps_script):
+    """Upload a script to S3 under its content hash and return its URL."""
+    body = ps_script.encode("utf-8")
+    key = f"{SCRIPTS_PREFIX}/{hashlib.sha256(body).hexdigest()}/{script_name}"
+    try:
+        s3.put_object(Bucket=SCRIPTS_BUCKET, Key=key, Body=body, IfNoneMatch="*")
+    except ClientError as e:
+        # Same content already uploaded by an earlier run
+        if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+            raise
+    return f"https://{SCRIPTS_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{key}"
+
+
+def load_scripts():
+    """Read each package script once and build its SendCommand parameters."""
+    script_params = {}
+    for pkg, script_name in name_map.items():
+        with open(f"scripts/{script_name}", "r") as f:
+            ps_script = f.read()
+
+        if SCRIPTS_BUCKET:
+            url = upload_script(script_name, ps_script)
+            script_params[pkg] = {
+                "DocumentName": "AWS-RunRemoteScript",
+                "Parameters": {
+                    "sourceType": ["S3"],
+                    "sourceInfo": [json.dumps({"path": url})],
+                    "commandLine": [f"powershell.exe -ExecutionPolicy Bypass -File {script_name}"],
+                },
+                "Comment": f"install-{pkg}",
+            }
+        else:
+            script_params[pkg] = {
+                "DocumentName": "AWS-RunPowerShellScript",
+                "Parameters": {"commands": [compress_script(ps_script)]},
+                "Comment": f"install-{pkg}",
+            }
+    return script_params
+
+
+def send_ssm_command(instance_ids, base_params):
+    """Send one SSM RunCommand for a prepared script to a batch of instances."""
+    params = dict(base_params, InstanceIds=instance_ids)
+    with send_slots:
+        response = call_with_backoff(ssm.send_command, **params)
     return response["Command"]["CommandId"]
 
 
-def wait_for_command(command_id, instance_id):
-    """Wait until SSM command completes and return output."""
+def send_to_batch(instance_ids, base_params):
+    """Send a command to a batch and return {instance_id: command_id or error}.
+
+    SSM rejects the whole call with InvalidInstanceId if any one instance is
+    unknown or offline, so in that case fall back to one send per instance.
+    """
+    try:
+        command_id = send_ssm_command(instance_ids, base_params)
+        return {instance_id: command_id for instance_id in instance_ids}
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "InvalidInstanceId":
+            raise
+        if len(instance_ids) == 1:
+            return {instance_ids[0]: e}
+
+    sent = {}
+    for instance_id in instance_ids:
+        try:
+            sent[instance_id] = send_ssm_command([instance_id], base_params)
+        except Exception as e:
+            sent[instance_id] = e
+    return sent
+
+
+def rejected_instances(sent):
+    """Return {instance_id: error message} for instances SSM refused outright."""
+    return {
+        instance_id: str(result)
+        for instance_id, result in sent.items()
+        if isinstance(result, ClientError) and result.response["Error"]["Code"] == "InvalidInstanceId"
+    }
+
+
+def wait_for_command(command_id, instance_id, deadline):
+    """Wait until SSM command completes, or the deadline passes, and return output."""
+    status, output = "Pending", ""
+    delay = POLL_MIN
     while True:
-        time.sleep(5)
-        result = ssm.list_command_invocations(
-            CommandId=command_id,
-            InstanceId=instance_id,
-            Details=True
-        )
-        if result["CommandInvocations"]:
-            status = result["CommandInvocations"][0]["Status"]
-            if status in ["Success", "Failed", "Cancelled", "TimedOut"]:
-                output = result["CommandInvocations"][0]["CommandPlugins"][0].get("Output", "")
-                return status, output
+        try:
+            result = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+            status = result["Status"]
+        except ssm.exceptions.InvocationDoesNotExist:
+            pass  # Not visible yet right after SendCommand
 
+        if status in TERMINAL_STATUSES:
+            output = result.get("StandardOutputContent", "")
+            if result.get("StandardErrorContent"):
+                output += "\n" + result["StandardErrorContent"]
+            return status, output, result.get("ResponseCode")
+        if time.time() >= deadline:
+            return status, output, None
+        time.sleep(delay + random.uniform(0, 0.5))
+        delay = min(POLL_MAX, delay * 1.5)
 
-def main():
-    report = []
 
-    with open(CSV_FILE, newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            workspace_id = row["workspace_id"]
-            username = row["username"]
+def probe_installed(targets):
+    """Ask a batch of workspaces, in one SSM command, which packages they already have.
 
-            try:
-                ws_id, computer_name = get_instance_id_from_workspace(workspace_id)
-                instance_id = workspace_id  # Adjust if mapping to EC2 ID via Fleet Manager
+    Returns ({instance_id: installed packages}, {instance_id: rejection}).
+    """
+    instance_ids = [t["instance_id"] for t in targets]
+    installed = {instance_id: set() for instance_id in instance_ids}
+    try:
+        sent = send_to_batch(instance_ids, PROBE_PARAMS)
+    except Exception as e:
+        print(f"[WARN] Install probe failed for batch of {len(targets)}: {e}")
+        return installed, {}
+
+    deadline = time.time() + PROBE_TIMEOUT
+    for instance_id in instance_ids:
+        try:
+            command_id = sent[instance_id]
+            if isinstance(command_id, Exception):
+                raise command_id
+            status, output, _ = wait_for_command(command_id, instance_id, deadline)
+            if status != "Success":
+                raise RuntimeError(f"probe {status}")
+            checks = json.loads(next(line for line in reversed(output.splitlines()) if line.startswith("{")))
+            installed[instance_id] = {pkg for pkg, present in checks.items() if present}
+        except Exception as e:
+            # Fall back to running every installer on this workspace
+            print(f"[WARN] Install probe failed on {instance_id}: {e}")
+    return installed, rejected_instances(sent)
+
+
+def snip(text, limit=OUTPUT_SNIPPET):
+    """Return text cut to limit characters, without copying short strings."""
+    return text if len(text) <= limit else text[:limit]
+
+
+def to_json_line(event):
+    """Serialize an event as one JSON line, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(event).decode() + "\n"
+    return json.dumps(event) + "\n"
 
-                print(f"\n[INFO] Processing {workspace_id} ({username}, {computer_name})")
 
-                for pkg, script in name_map.items():
-                    print(f"[INFO] Installing {pkg} on {workspace_id}...")
+def make_recorder(report_file, summary, events_file=None):
+    """Return a thread-safe function that streams one result to the CSV report
+    and, if given, to a JSON-lines events file."""
+    writer = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    lock = threading.Lock()
 
-                    command_id = send_ssm_command(instance_id, script)
-                    status, output = wait_for_command(command_id, instance_id)
+    def record(workspace_id, username, package, status, output, command_id=None, rc=None):
+        if events_file is not None:
+            line = to_json_line({
+                "event": "result",
+                "workspace_id": workspace_id,
+                "script": package,
+                "status": status,
+                "rc": rc,
+                "command_id": command_id,
+                "ts": time.time(),
+            })
+        with lock:
+            writer.writerow({
+                "workspace_id": workspace_id,
+                "username": username,
+                "package": package,
+                "status": status,
+                "output": output
+            })
+            report_file.flush()
+            if events_file is not None:
+                events_file.write(line)
+                events_file.flush()
+            summary.append(f"{workspace_id} ({username}) - {package}: {status}")
 
-                    report.append({
-                        "workspace_id": workspace_id,
-                        "username": username,
-                        "package": pkg,
-                        "status": status,
-                        "output": output.strip()[:200]  # Truncate for readability
-                    })
+    return record
 
-                    print(f"[{status}] {pkg} on {workspace_id}")
-                    if output:
-                        print(f"Output: {output[:200]}")
 
+def install_package(pkg, params, targets, record):
+    """Install one package on a batch of workspaces with a single SSM command.
+
+    Returns {instance_id: rejection} for instances SSM refused the command for.
+    """
+    try:
+        sent = send_to_batch([t["instance_id"] for t in targets], params)
+    except Exception as e:
+        for t in targets:
+            record(t["workspace_id"], t["username"], pkg, "ERROR", str(e))
+        print(f"[ERROR] {pkg} on batch of {len(targets)}: {e}")
+        return {}
+
+    # The command runs on every target at once and all waits share one
+    # deadline, so waiting on them in turn costs no more than the slowest.
+    deadline = time.time() + COMMAND_TIMEOUT
+    for t in targets:
+        workspace_id = t["workspace_id"]
+        command_id = sent[t["instance_id"]]
+        if isinstance(command_id, Exception):
+            status, output, rc, command_id = "ERROR", str(command_id), None, None
+        else:
+            try:
+                status, output, rc = wait_for_command(command_id, t["instance_id"], deadline)
             except Exception as e:
-                report.append({
-                    "workspace_id": workspace_id,
-                    "username": username,
-                    "package": "ALL",
-                    "status": "ERROR",
-                    "output": str(e)
-                })
-                print(f"[ERROR] {workspace_id}: {e}")
+                status, output, rc = "ERROR", str(e), None
+
+        snippet = snip(output.strip())
+        record(workspace_id, t["username"], pkg, status, snippet, command_id, rc)
+
+        print(f"[{status}] {pkg} on {workspace_id}")
+        if snippet:
+            print(f"Output: {snippet}")
+
+    return rejected_instances(sent)
+
+
+def process_batch(targets, script_params, record):
+    """Run every package, in order, on one batch of workspaces."""
+    installed, rejected = probe_installed(targets) if PROBE_INSTALLED else ({}, {})
+
+    for pkg, params in script_params.items():
+        pending = []
+        for t in targets:
+            if t["instance_id"] in rejected:
+                # Already refused by SSM in this run; sending again would only
+                # make the whole batch fail and fall back to per-instance sends
+                record(t["workspace_id"], t["username"], pkg, "ERROR",
+                       f"Not sent, SSM rejected instance: {rejected[t['instance_id']]}")
+            elif pkg in installed.get(t["instance_id"], ()):
+                record(t["workspace_id"], t["username"], pkg, "SKIPPED", "Already installed")
+            else:
+                pending.append(t)
+
+        print(f"[INFO] Installing {pkg} on {len(pending)} workspaces "
+              f"({len(targets) - len(pending)} skipped)...")
+        if pending:
+            rejected.update(install_package(pkg, params, pending, record))
+
+
+def main():
+    summary = []
+    targets = []
+
+    # Script loading and the two AWS lookups are independent, so overlap them.
+    # Instance IDs are the workspace IDs, which lets the SSM check start
+    # without waiting for DescribeWorkspaces.
+    with ThreadPoolExecutor(max_workers=3) as startup:
+        scripts_future = startup.submit(load_scripts)
+        rows = read_workspaces(CSV_FILE)
+        workspace_ids = list(dict.fromkeys(row["workspace_id"] for row in rows))
+        names_future = startup.submit(describe_workspaces, workspace_ids)
+        managed_future = startup.submit(resolve_ssm_managed_instances, workspace_ids)
+        script_params = scripts_future.result()
+        computer_names, lookup_errors = names_future.result()
+        managed, ssm_errors = managed_future.result()
+
+    with ExitStack() as stack:
+        report_file = stack.enter_context(open(REPORT_CSV, "w", newline=""))
+        events_file = stack.enter_context(open(REPORT_JSONL, "w")) if REPORT_JSONL else None
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=MAX_WORKERS))
+        record = make_recorder(report_file, summary, events_file)
+
+        seen = set()
+        for row in rows:
+            workspace_id = row["workspace_id"]
+            if workspace_id in seen:
+                print(f"[WARN] {workspace_id}: duplicate CSV row ignored")
+                continue
+            seen.add(workspace_id)
+            if workspace_id not in computer_names:
+                error = lookup_errors.get(workspace_id, f"No workspace found for {workspace_id}")
+                record(workspace_id, row["username"], "ALL", "ERROR", error)
+                print(f"[ERROR] {workspace_id}: {error}")
+                continue
+            targets.append({
+                "workspace_id": workspace_id,
+                "username": row["username"],
+                "instance_id": workspace_id,  # Adjust if mapping to EC2 ID via Fleet Manager
+                "computer_name": computer_names[workspace_id],
+            })
+
+        for t in targets:
+            if t["instance_id"] in managed:
+                print(f"[INFO] Processing {t['workspace_id']} ({t['username']}, {t['computer_name']})")
+                continue
+            error = ssm_errors.get(t["instance_id"], "Instance is not managed by SSM or is offline")
+            record(t["workspace_id"], t["username"], "ALL", "ERROR", error)
+            print(f"[ERROR] {t['workspace_id']}: {error}")
+        targets = [t for t in targets if t["instance_id"] in managed]
+
+        # Each batch runs its own package sequence, so a slow batch never
+        # holds up the others and every workspace keeps the install order
+        futures = [
+            executor.submit(process_batch, batch, script_params, record)
+            for batch in chunked(targets, SSM_BATCH_SIZE)
+        ]
+        for future in as_completed(futures):
+            future.result()
 
     print("\n===== FINAL REPORT =====")
-    for r in report:
-        print(f"{r['workspace_id']} ({r['username']}) - {r['package']}: {r['status']}")
+    for line in summary:
+        print(line)
+    print(f"Full results written to {REPORT_CSV}")
+    if REPORT_JSONL:
+        print(f"Result events written to {REPORT_JSONL}")
 
 if __name__ == "__main__":
     main()